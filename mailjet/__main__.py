@@ -1,28 +1,38 @@
 # -*- coding: utf8 -*-
 
 import argparse
-import binascii
+from contextlib import nullcontext
 import json
 import os
+import re
 import socket
-from typing import Iterable, List, Optional, Set, Tuple
+from typing import Iterable, List, Optional, Tuple, TYPE_CHECKING
 
-from openpyxl import load_workbook
-from openpyxl import Workbook
-from openpyxl.worksheet.worksheet import Worksheet
-import phonenumbers
-from phonenumbers import PhoneNumberFormat as Formats
-from phonenumbers.phonenumberutil import NumberParseException
-import requests
+# The third-party packages are slow to import, so they are imported where
+# they are used, letting `--help` and dry-runs skip the ones they don't need.
+if TYPE_CHECKING:
+    from openpyxl import Workbook
+    from openpyxl.worksheet.worksheet import Worksheet
 
 from .settings import ACCESS_TOKEN
 
 
 API_URL = 'https://api.mailjet.com/v4/sms-send'
 
-SMS_SIZES = [
-    (160, 70), (306, 134), (459, 201), (612, 268), (765, 335)
-]
+# Characters per message as (single, per-part when concatenated).
+SMS_SIZES = {
+    'gsm7': (160, 153),
+    'utf16': (70, 67),
+}
+MAX_CONCATENATED_MESSAGES = 5
+
+E164_PATTERN = re.compile(r'\+[0-9]{1,15}')
+
+RECIPIENT_HEADERS = frozenset(('sms', 'cell', 'mobile', 'telephone'))
+
+# Invisible BiDi/formatting marks and NBSP sometimes found in pasted numbers.
+_STRIP = str.maketrans(
+    '', '', '\u202d\u202a\u202b\u202c\u202e\u200e\u200f\u200b\u00a0')
 
 GSM7_CHARSET = (
     "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"  # noqa
@@ -33,6 +43,12 @@ EXT_CHARSET = (
     "|````````````````````````````````````€``````````````````````````"
 )
 
+# Character -> septet lookups. The backtick is only padding in EXT_CHARSET.
+GSM7_MAP = {c: i for i, c in enumerate(GSM7_CHARSET)}
+EXT_MAP = {c: i for i, c in enumerate(EXT_CHARSET) if c != '`'}
+_GSM7_TRANS = str.maketrans(GSM7_MAP)
+_GSM7_SET = frozenset(GSM7_CHARSET)
+
 
 class RecipientsNotFoundException(Exception):
     """Indicate that a column of recipients could not be found."""
@@ -43,20 +59,33 @@ class UnableToCleanException(Exception):
 
 
 def gsm_encode(plaintext):
-    """Convert unicode to GSM-7 encoded text."""
+    """
+    Convert unicode to GSM-7 encoded text.
+
+    Return the characters that could not be encoded and the encoded septets,
+    one per byte. Extended characters take two septets (ESC plus the code),
+    so the length of the latter is the number of septets to be sent. Use
+    `.hex()` on it if a hex string is needed.
+    """
     # Inspired by https://stackoverflow.com/a/2453027
+    if _GSM7_SET.issuperset(plaintext):
+        # Fast path: every character maps to a single septet.
+        return [], plaintext.translate(_GSM7_TRANS).encode('latin-1')
+
     chars_omitted = []
-    res = ""
+    out = bytearray()
     for c in plaintext:
-        idx = GSM7_CHARSET.find(c)
-        if idx != -1:
-            res += chr(idx)
+        idx = GSM7_MAP.get(c)
+        if idx is not None:
+            out.append(idx)
             continue
-        idx = EXT_CHARSET.find(c)
-        if idx != -1:
-            res += chr(27) + chr(idx)
-        chars_omitted.append(c)
-    return chars_omitted, binascii.b2a_hex(res.encode('utf-8'))
+        idx = EXT_MAP.get(c)
+        if idx is not None:
+            out.append(27)
+            out.append(idx)
+        else:
+            chars_omitted.append(c)
+    return chars_omitted, bytes(out)
 
 
 def send_sms(msg: str, recipient_list: Iterable[str],
@@ -92,19 +121,41 @@ def send_sms(msg: str, recipient_list: Iterable[str],
     else:
         data['Text'] = msg
 
-    for recipient in recipient_list:
-        data["To"] = recipient
-        if dry_run:
-            print(f'DRY_RUN: Pretend a message was sent to {recipient}')
-        else:
-            res = requests.post(url=API_URL, data=json.dumps(data),
-                                headers=headers)
-            if res.status_code != 200:
-                print(f'Message not sent to {recipient}. An error '
-                      f'({res.status_code}) occurred: "{res.content}"')
-
+    # Only "To" changes per recipient, so serialize everything else once and
+    # splice each (E.164, hence JSON-safe) recipient into the body.
+    body_prefix = json.dumps(data)[:-1].encode('utf-8') + b', "To": "'
+    body_suffix = b'"}'
 
-def find_recipient_data(workbook: Workbook) -> Tuple[Worksheet, int]:
+    if dry_run:
+        session = nullcontext()
+    else:
+        import requests
+
+        # Re-use a single connection to the API for all recipients.
+        session = requests.Session()
+        session.headers.update(headers)
+
+    with session:
+        for recipient in recipient_list:
+            if not E164_PATTERN.fullmatch(recipient):
+                print(f'Message not sent to {recipient}. It is not in the '
+                      f'international (E.164) format.')
+            elif dry_run:
+                print(f'DRY_RUN: Pretend a message was sent to {recipient}')
+            else:
+                body = (body_prefix + recipient.encode('ascii')
+                        + body_suffix)
+                # Mailjet answers accepted messages with 201 Created, so any
+                # 2xx is a success. The body has already been read by now;
+                # closing the response is just tidiness.
+                with session.post(url=API_URL, data=body) as res:
+                    if not 200 <= res.status_code < 300:
+                        print(f'Message not sent to {recipient}. An error '
+                              f'({res.status_code}) occurred: '
+                              f'"{res.content}"')
+
+
+def find_recipient_data(workbook: 'Workbook') -> Tuple['Worksheet', int]:
     """
     If found, return the worksheet and column index that contains recipients.
 
@@ -127,13 +178,19 @@ def find_recipient_data(workbook: Workbook) -> Tuple[Worksheet, int]:
     RecipientsNotFoundException
         If no appropriate column could be found.
     """
-    for sheet in workbook.worksheets:
-        for c in range(1, sheet.max_column):
-            val = sheet.cell(1, c).value
-            if val.lower() in ['sms', 'cell', 'mobile', 'telephone']:
-                return sheet, c
-
-    raise RecipientsNotFoundException('Could not find an appropriate column.')
+    matches = (
+        (sheet, c)
+        for sheet in workbook.worksheets
+        for c, val in enumerate(
+            next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), ()),
+            start=1)
+        if val and str(val).lower() in RECIPIENT_HEADERS
+    )
+    try:
+        return next(matches)
+    except StopIteration:
+        raise RecipientsNotFoundException(
+            'Could not find an appropriate column.') from None
 
 
 def get_recipients(file_path: str = None) -> Optional[List[str]]:
@@ -148,18 +205,28 @@ def get_recipients(file_path: str = None) -> Optional[List[str]]:
     Returns
     -------
     List[str] or None
-        A list of recipients (telephone numbers)
+        A list of the non-empty recipients (telephone numbers) in the order
+        they appear.
     """
     if not file_path:
         raise ValueError('A valid file path is required.')
-    book = load_workbook(filename=file_path, read_only=True)
+
+    from openpyxl import load_workbook
+
+    book = load_workbook(filename=file_path, read_only=True, data_only=True,
+                         keep_links=False)
 
     try:
         sheet_name, column_num = find_recipient_data(book)
+        # This stays eager (rather than a generator) so that errors are
+        # reported here and run() can tell when nothing was found. Stripping
+        # and de-duplicating are left to clean_phone_numbers. Non-text cells
+        # are converted so they are reported as unparseable.
         recipients_list = [
-            cell[0] for cell in sheet_name.iter_rows(
+            str(value) for value, in sheet_name.iter_rows(
                 min_row=2, min_col=column_num, max_col=column_num,
                 values_only=True)
+            if value
         ]
     except RecipientsNotFoundException:
         print('An XLSX workbook that contains a worksheet containing a '
@@ -171,36 +238,56 @@ def get_recipients(file_path: str = None) -> Optional[List[str]]:
               'the recipients from the XLSX file.')
     else:
         return recipients_list
+    finally:
+        # Read-only workbooks keep the underlying file open until closed.
+        book.close()
+
 
+def _to_e164(num: str) -> Optional[str]:
+    """Return `num` in E.164 format, or None if it is not a valid number."""
+    import phonenumbers
+    from phonenumbers import PhoneNumberFormat as Formats
 
-def clean_phone_numbers(phone_list) -> Set[str]:
+    parsed = phonenumbers.parse(num)
+    if phonenumbers.is_valid_number(parsed):
+        return phonenumbers.format_number(parsed, Formats.E164)
+    return None
+
+
+def clean_phone_numbers(phone_list: Iterable[str]) -> List[str]:
     """
-    Clean a list of phone numbers into a set of E164 formatted numbers.
+    Clean a list of phone numbers into a list of unique E164 numbers.
 
     Parameters
     ----------
-    phone_list : List[str]
+    phone_list : Iterable[str]
 
     Returns
     -------
-    Set[str]
-        A set of the cleaned numbers in E164 format or None if ANY number
-        could not be parsed into E.164.
+    List[str]
+        The unique cleaned numbers in E164 format, in the order they were
+        first listed.
 
     Raises
     ------
     UnableToCleanException
         If one or more entries were not parse-able into E.164 format.
     """
+    from phonenumbers.phonenumberutil import NumberParseException
+
     error_found = False
-    cleaned_numbers = set()
+    # A dict de-duplicates while preserving the original order.
+    cleaned_numbers = {}
 
-    # Strip out LRO characters that seem prevalent in the sample file.
-    phone_list = [p.replace('\u202d', '') for p in phone_list]
+    # Strip out LRO (and similar) characters that seem prevalent in the
+    # sample file, dropping empty entries along the way. Duplicates only need
+    # to be parsed (and reported) once.
+    unique_numbers = dict.fromkeys(
+        p.translate(_STRIP) for p in phone_list if p)
 
-    for num in phone_list:
+    for num in unique_numbers:
         try:
-            parsed = phonenumbers.parse(num)
+            e164 = _to_e164(num)
         except (NumberParseException, TypeError):
             print(f'The telephone number provided: "{num}" raised an '
                   f'unexpected error while attempting to parse it. Please '
@@ -208,9 +295,8 @@ def clean_phone_numbers(phone_list) -> Set[str]:
                   f'format-able telephone number and try again.')
             error_found = True
         else:
-            if phonenumbers.is_valid_number(parsed):
-                cleaned_numbers.add(
-                    phonenumbers.format_number(parsed, Formats.E164))
+            if e164 is not None:
+                cleaned_numbers[e164] = None
             else:
                 print(f'The telephone number provided: "{num}" does not '
                       f'appear to be a valid telephone number. Please correct '
@@ -221,18 +307,17 @@ def clean_phone_numbers(phone_list) -> Set[str]:
     if error_found:
         raise UnableToCleanException()
     else:
-        return cleaned_numbers
+        return list(cleaned_numbers)
 
 
 def count_messages(num_characters, mode='gsm7') -> Optional[int]:
     """Calculate the number of concatenated messages would be required."""
-    for idx, (gsm7, utf16) in enumerate(SMS_SIZES):
-        if mode == 'gsm7':
-            if gsm7 >= num_characters:
-                return idx + 1
-        else:
-            if utf16 >= num_characters:
-                return idx + 1
+    single, part = SMS_SIZES['gsm7' if mode == 'gsm7' else 'utf16']
+    if num_characters <= single:
+        return 1
+    num_messages = -(-num_characters // part)
+    if num_messages <= MAX_CONCATENATED_MESSAGES:
+        return num_messages
     return None
 
 
@@ -253,12 +338,29 @@ def clean_message(message: str, dry_run: bool) -> bool:
     -------
     bool
         True if message is send-able.
+
+    Examples
+    --------
+    Extended characters take two septets and omitted characters are counted
+    as the single symbol that would replace them.
+
+    >>> clean_message('x' * 159 + '{', dry_run=False)
+    This message will be sent as 2 concatenated GSM-7 encoded messages.
+    True
+    >>> clean_message('x' * 159 + '\U0001f600' * 2, dry_run=True)
+    ... # doctest: +ELLIPSIS
+    SUGGESTION: ... would cost ~33% less to send.
+    This message will be sent as 3 concatenated UTF-16 encoded messages.
+    True
     """
-    characters_omitted, gsm7_msg = gsm_encode(message)
-    num_gsm7_msgs = count_messages(len(message), 'gsm7')
-    num_utf16_msgs = count_messages(len(message), 'utf16')
+    characters_omitted, encoded = gsm_encode(message)
+    # Size the message as if each omitted character were replaced by a single
+    # GSM-7 symbol, as the suggestions below assume.
+    num_septets = len(encoded) + len(characters_omitted)
+    num_gsm7_msgs = count_messages(num_septets, 'gsm7')
 
     if characters_omitted:
+        num_utf16_msgs = count_messages(len(message), 'utf16')
         if num_utf16_msgs is None:
             # This is a Unicode message and it is too big to send. ERROR.
             print(f'ERROR: This message is too long to be sent via SMS in '
@@ -323,7 +425,7 @@ def run(*, message: str = None,
         If set, do everything EXCEPT make a request to the MailJet API.
     """
     if sender is None:
-        sender = os.getenv('USER', socket.gethostname())
+        sender = os.environ.get('USER') or socket.gethostname()
     print(f'Using a "sender" value of "{sender}". '
           f'Use the `-s` option to modify.')
 